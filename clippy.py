@@ -30,18 +30,50 @@ if __name__ == "__main__":
         "chainloader": "aarch64-unknown-none",
     }
 
+    # one cargo invocation per target, so cargo can lint that target's crates in
+    # parallel; separate invocations would just serialize on the target directory lock
+    groups = {}
     for pkg in members:
-        name = pkg["name"]
-        cmd = ["cargo", "clippy", "-p", name, "--message-format=json"]
-        if name in TARGETS:
-            cmd += ["--target", TARGETS[name]]
+        groups.setdefault(TARGETS.get(pkg["name"]), []).append(pkg)
 
-        with subprocess.Popen(cmd, cwd=workspace_root, text=True, stdout=subprocess.PIPE) as proc:
+    for target, pkgs in groups.items():
+        names = {pkg["id"]: pkg["name"] for pkg in pkgs}
+        # cargo emits compact single-line objects, so the field can be spliced in
+        # before the closing brace without round-tripping the message through json
+        suffixes = {
+            pkg["id"].encode(): f',"workspace_package":{json.dumps(pkg["name"])}}}\n'.encode()
+            for pkg in pkgs
+        }
+        cmd = ["cargo", "clippy", "--message-format=json"]
+        for pkg in pkgs:
+            cmd += ["-p", pkg["name"]]
+        if target is not None:
+            cmd += ["--target", target]
+
+        out = sys.stdout.buffer
+        with subprocess.Popen(cmd, cwd=workspace_root, stdout=subprocess.PIPE) as proc:
             for line in proc.stdout:
+                body = line.rstrip()
+                if not (body.startswith(b"{") and body.endswith(b"}")):
+                    continue
+
+                start = body.find(b'"package_id":"')
+                if start != -1:
+                    start += len(b'"package_id":"')
+                    suffix = suffixes.get(body[start:body.find(b'"', start)])
+                    if suffix is None:
+                        out.write(body + b"\n")
+                    else:
+                        out.write(body[:-1] + suffix)
+                    continue
+
+                # no package id in the expected spot, fall back to parsing the message
                 try:
-                    obj = json.loads(line)
-                    obj["workspace_package"] = name
-                    print(json.dumps(obj))
+                    obj = json.loads(body)
+                    name = names.get(obj.get("package_id"))
+                    if name is not None:
+                        obj["workspace_package"] = name
+                    out.write(json.dumps(obj).encode() + b"\n")
                 except json.JSONDecodeError:
                     continue
             if proc.wait() != 0:
@@ -20,6 +20,7 @@ const GPPUD: *mut u32 = (GPIO_BASE + 0x94) as *mut u32;
 const GPPUDCLK0: *mut u32 = (GPIO_BASE + 0x98) as *mut u32;
 
 const UART0_DR: *mut u32 = (UART0_BASE + 0x00) as *mut u32;
+const UART0_RSRECR: *mut u32 = (UART0_BASE + 0x04) as *mut u32;
 const UART0_FR: *mut u32 = (UART0_BASE + 0x18) as *mut u32;
 const UART0_IBRD: *mut u32 = (UART0_BASE + 0x24) as *mut u32;
 const UART0_FBRD: *mut u32 = (UART0_BASE + 0x28) as *mut u32;
@@ -56,6 +57,71 @@ pub fn getchar() -> u8 {
     }
 }
 
+/// Like [`getchar`], but returns `None` if the byte arrived with a framing, parity,
+/// break, or overrun error.
+pub fn getchar_checked() -> Option<u8> {
+    unsafe {
+        while UART0_FR.read_volatile() & 0x10 != 0 {
+            asm!("nop");
+        }
+        let dr = UART0_DR.read_volatile();
+        (dr & 0xF00 == 0).then_some(dr as u8)
+    }
+}
+
+pub fn getu32() -> u32 {
+    let mut n: u32 = 0;
+    n |= getchar() as u32;
+    n |= (getchar() as u32) << 8;
+    n |= (getchar() as u32) << 16;
+    n |= (getchar() as u32) << 24;
+    n
+}
+
+/// Folds one byte into a running CRC-32 (the zlib/ISO-HDLC polynomial, reflected) with
+/// the ARMv8 CRC32 instructions, which the Pi 4's Cortex-A72 implements.
+pub fn crc32_update(crc: u32, byte: u8) -> u32 {
+    let out: u32;
+    unsafe {
+        asm!(
+            ".arch_extension crc",
+            "crc32b {out:w}, {crc:w}, {byte:w}",
+            out = lateout(reg) out,
+            crc = in(reg) crc,
+            byte = in(reg) byte as u32,
+            options(pure, nomem, nostack),
+        );
+    }
+    out
+}
+
+pub fn counter() -> u64 {
+    let cnt: u64;
+    unsafe {
+        asm!("mrs {}, cntpct_el0", out(reg) cnt);
+    }
+    cnt
+}
+
+/// Throws away received bytes until the line has been idle for about 100 ms.
+pub fn drain() {
+    let freq: u64;
+    unsafe {
+        asm!("mrs {}, cntfrq_el0", out(reg) freq);
+    }
+    let mut last = counter();
+    while counter() - last < freq / 10 {
+        unsafe {
+            if UART0_FR.read_volatile() & 0x10 == 0 {
+                UART0_DR.read_volatile();
+                last = counter();
+            }
+        }
+    }
+    // clear the error flags left behind by the bad transfer
+    unsafe { UART0_RSRECR.write_volatile(0) };
+}
+
 pub fn delay(mut cnt: usize) {
     unsafe {
         while cnt != 0 {
@@ -83,31 +149,45 @@ pub extern "C" fn recv(_load_addr: usize) -> ! {
         UART0_ICR.write_volatile(0x7ff);
         UART0_IBRD.write_volatile(3);
         UART0_FBRD.write_volatile(16);
-        UART0_LCRH.write_volatile(0x3 << 5);
+        // 8 data bits, FIFOs enabled
+        UART0_LCRH.write_volatile((0x3 << 5) | (1 << 4));
         UART0_CR.write_volatile(0x301);
     }
 
-    putchar(3);
-    putchar(3);
-    putchar(3);
+    loop {
+        putchar(3);
+        putchar(3);
+        putchar(3);
 
-    let mut kernel_len: u32 = 0;
-    kernel_len |= getchar() as u32;
-    kernel_len |= (getchar() as u32) << 8;
-    kernel_len |= (getchar() as u32) << 16;
-    kernel_len |= (getchar() as u32) << 24;
+        let kernel_len = getu32();
 
-    putchar(b'O');
-    putchar(b'K');
+        putchar(b'O');
+        putchar(b'K');
 
-    unsafe {
+        let mut crc = !0u32;
+        let mut rx_ok = true;
         let mut i: usize = 0;
-        while i < kernel_len as usize {
-            let c = getchar();
-            ((KERNEL_LOAD_ADDR + i) as *mut u8).write_volatile(c);
-            putchar(c);
-            i += 1;
+        while rx_ok && i < kernel_len as usize {
+            if let Some(c) = getchar_checked() {
+                unsafe { ((KERNEL_LOAD_ADDR + i) as *mut u8).write_volatile(c) };
+                crc = crc32_update(crc, c);
+                i += 1;
+            } else {
+                rx_ok = false;
+            }
         }
+
+        if rx_ok && getu32() == !crc {
+            break;
+        }
+
+        // receive error or checksum mismatch: report it right away, then let the rest of
+        // the (possibly misaligned) stream go by and wait for the kernel to be sent again
+        putchar(b'B');
+        putchar(b'A');
+        putchar(b'D');
+        putchar(b'!');
+        drain();
     }
 
     putchar(b'T');
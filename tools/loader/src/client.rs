@@ -1,15 +1,26 @@
 use std::{
+    fs::File,
     net::{IpAddr, Ipv4Addr, SocketAddr},
-    path::PathBuf,
+    path::{Path, PathBuf},
 };
 
 use indicatif::{ProgressBar, ProgressStyle};
+use memmap2::Mmap;
 use tokio::{
     io::{self, AsyncReadExt, AsyncWriteExt},
-    net::{TcpStream, tcp::WriteHalf},
+    net::{TcpStream, tcp::ReadHalf},
+    sync::mpsc,
+    time::Duration,
 };
 use xmas_elf::{ElfFile, sections::SectionData, symbol_table::Entry};
 
+/// Baud rate the chainloader programs into the UART; must match its
+/// `UART0_IBRD`/`UART0_FBRD` divisor
+const CHAINLOADER_BAUD: u32 = 921600;
+
+/// How many times to send the kernel before giving up on repeated corruption
+const MAX_SEND_ATTEMPTS: u32 = 3;
+
 #[derive(Debug, clap::Args)]
 pub struct ClientConfig {
     /// Path to the kernel binary to send over serial
@@ -20,26 +31,22 @@ pub struct ClientConfig {
     /// Address to connect to
     #[clap(long, default_value_t = SocketAddr::new(IpAddr::V4(Ipv4Addr::LOCALHOST), 1235))]
     addr: SocketAddr,
-    /// Chunk size for kernel transfer
-    #[clap(long, default_value_t = 16*1024)]
+    /// Size of each socket write while sending the kernel, and of the monitor read buffer
+    #[clap(long, default_value_t = 64*1024)]
     chunk_size: usize,
 }
 
 pub struct Client {
-    kernel: Vec<u8>,
-    symbols: Option<Vec<u8>>,
+    kernel: Mmap,
+    symbols: Option<Mmap>,
     conn: TcpStream,
     chunk_size: usize,
 }
 
 impl Client {
     pub async fn connect(config: &ClientConfig) -> io::Result<Self> {
-        let kernel = tokio::fs::read(&config.kernel_path).await?;
-        let symbols = if let Some(symbol_path) = &config.symbol_path {
-            Some(tokio::fs::read(symbol_path).await?)
-        } else {
-            None
-        };
+        let kernel = map_file(&config.kernel_path)?;
+        let symbols = config.symbol_path.as_deref().map(map_file).transpose()?;
 
         let conn = TcpStream::connect(config.addr).await?;
         conn.set_nodelay(true)?;
@@ -73,54 +80,80 @@ impl Client {
 
     async fn send_kernel_inner(&mut self) -> io::Result<()> {
         let (mut reader, mut writer) = self.conn.split();
+        let kernel = &self.kernel;
+        // crc32fast picks the PCLMULQDQ or ARMv8 CRC32 path at runtime where available
+        let checksum = crc32fast::hash(kernel);
 
         log::info!("Power cycle your Pi now!");
-        let mut num_breaks = 0;
-        while num_breaks < 3 {
-            let c = reader.read_u8().await?;
-            if c == b'\x03' {
-                num_breaks += 1;
-            } else {
-                num_breaks = 0;
+        let mut attempt = 1;
+        loop {
+            wait_for_ready(&mut reader).await?;
+
+            log::info!("Sending kernel ({:#x} bytes)...", kernel.len());
+            let pbar = ProgressBar::new(kernel.len() as u64).with_style(
+                ProgressStyle::default_bar()
+                    .template(
+                        "[{elapsed_precise}/{duration_precise}] {wide_bar} {bytes}/{total_bytes}",
+                    )
+                    .unwrap(),
+            );
+
+            // the size header goes out in the same write as the first chunk
+            let (first, rest) = kernel.split_at(self.chunk_size.min(kernel.len()));
+            let mut head = Vec::with_capacity(4 + first.len());
+            head.extend_from_slice(&(kernel.len() as u32).to_le_bytes());
+            head.extend_from_slice(first);
+            writer.write_all(&head).await?;
+            pbar.inc(first.len() as u64);
+
+            for chunk in rest.chunks(self.chunk_size) {
+                writer.write_all(chunk).await?;
+                pbar.inc(chunk.len() as u64);
             }
-        }
 
-        log::info!("Sending kernel size ({:#x} bytes)", self.kernel.len());
-        writer
-            .write_all(&(self.kernel.len() as u32).to_le_bytes())
-            .await?;
+            // the chainloader doesn't echo the kernel back, it checks a CRC-32 of the
+            // whole image sent after it instead
+            writer.write_all(&checksum.to_le_bytes()).await?;
+            // the bar only counts bytes handed to the server, so the Pi may still be
+            // receiving the tail end of the kernel at this point
+            pbar.finish();
+            log::info!("Waiting for the chainloader to verify the checksum...");
 
-        let mut ok = [0u8; 2];
-        reader.read_exact(&mut ok).await?;
-        if &ok != b"OK" {
-            return Err(io::Error::other("Error in kernel transfer"));
-        }
+            // the writes above only fill local buffers, and a byte lost on the wire leaves
+            // the chainloader waiting for data that never comes, so bound the wait by
+            // how long the whole image takes at line rate (10 bits per byte)
+            let line_time =
+                Duration::from_secs_f64(kernel.len() as f64 * 10.0 / CHAINLOADER_BAUD as f64);
+            let reply = tokio::time::timeout(line_time * 2 + Duration::from_secs(5), async {
+                let mut reply = [0u8; 6];
+                reader.read_exact(&mut reply).await?;
+                io::Result::Ok(reply)
+            })
+            .await
+            .map_err(|_| {
+                io::Error::new(
+                    io::ErrorKind::TimedOut,
+                    "Timed out waiting for the chainloader to acknowledge the kernel",
+                )
+            })??;
 
-        log::info!("Sending kernel...");
-
-        let it = self.kernel.chunks(self.chunk_size);
-        let pbar = ProgressBar::new(self.kernel.len() as u64).with_style(
-            ProgressStyle::default_bar()
-                .template("[{elapsed_precise}/{duration_precise}] {wide_bar} {bytes}/{total_bytes} ({bytes_per_sec})")
-                .unwrap(),
-        );
-        let mut echo = vec![0u8; self.chunk_size];
-        for chunk in it {
-            writer.write_all(chunk).await?;
-
-            let current_chunk_size = chunk.len();
-            reader.read_exact(&mut echo[..current_chunk_size]).await?;
-            if &echo[..current_chunk_size] != chunk {
-                return Err(io::Error::other("Error in kernel transfer"));
+            match &reply {
+                b"OKTY:)" => break,
+                b"OKBAD!" if attempt < MAX_SEND_ATTEMPTS => {
+                    log::warn!("Kernel transfer corrupted, sending it again");
+                    attempt += 1;
+                }
+                b"OKBAD!" => {
+                    return Err(io::Error::other(format!(
+                        "Kernel transfer corrupted {MAX_SEND_ATTEMPTS} times, giving up"
+                    )));
+                }
+                _ => {
+                    return Err(io::Error::other(
+                        "Unexpected reply from the chainloader (rebuild and reflash it if it predates the CRC check)",
+                    ));
+                }
             }
-            pbar.inc(current_chunk_size as u64);
-        }
-        pbar.finish();
-        drop(echo);
-        let mut ty = [0u8; 4];
-        reader.read_exact(&mut ty).await?;
-        if &ty != b"TY:)" {
-            return Err(io::Error::other("Error in kernel transfer"));
         }
 
         log::info!("Kernel sent!");
@@ -152,65 +185,140 @@ impl Client {
             .map_err(|e| {
                 log::error!("Error parsing symbol file: {e}");
                 io::Error::new(io::ErrorKind::InvalidData, e)
-            })?;
+            })?
+            .map(|elf| SymbolTable::new(&elf));
 
         let (mut rx, mut tx) = self.conn.split();
-        let mut buf = vec![0u8; self.chunk_size];
-        loop {
-            let size = rx.read(&mut buf).await?;
-            let data = &buf[..size];
-            let is_symbol_request =
-                maybe_handle_symbol_request(symbols.as_ref(), data, &mut tx).await?;
-            if !is_symbol_request {
-                tokio::io::stdout().write_all(data).await?;
-                tokio::io::stdout().flush().await?;
+        let chunk_size = self.chunk_size;
+
+        // symbol requests are answered by a separate writer so that sending replies
+        // never holds up console output
+        let (reply_tx, mut reply_rx) = mpsc::unbounded_channel::<&[u8]>();
+
+        let read = async move {
+            let mut stdout = io::BufWriter::with_capacity(64 * 1024, io::stdout());
+            let mut buf = vec![0u8; chunk_size];
+            loop {
+                let size = rx.read(&mut buf).await?;
+                if size == 0 {
+                    log::info!("Server closed the connection");
+                    return io::Result::Ok(());
+                }
+                // everything but symbol requests reaches stdout in a single write per burst
+                for line in buf[..size].split_inclusive(|&b| b == b'\n') {
+                    if let Some(reply) = answer_symbol_request(symbols.as_ref(), line) {
+                        reply_tx
+                            .send(reply)
+                            .map_err(|_| io::Error::other("Symbol reply writer stopped"))?;
+                    } else {
+                        stdout.write_all(line).await?;
+                    }
+                }
+                stdout.flush().await?;
             }
-        }
+        };
+
+        let write = async move {
+            let mut reply = Vec::new();
+            while let Some(name) = reply_rx.recv().await {
+                reply.clear();
+                reply.extend_from_slice(name);
+                reply.push(b'\n');
+                tx.write_all(&reply).await?;
+            }
+            io::Result::Ok(())
+        };
+
+        tokio::try_join!(read, write)?;
+        Ok(())
     }
 }
 
-async fn maybe_handle_symbol_request(
-    symbols: Option<&ElfFile<'_>>,
-    data: &[u8],
-    tx: &mut WriteHalf<'_>,
-) -> io::Result<bool> {
-    if data.starts_with(b"[sym?]") {
-        if let Some(symbols) = symbols.as_ref() {
-            let addr = String::from_utf8_lossy(data.strip_prefix(b"[sym?]").unwrap());
-            if let Ok(addr) = addr.trim().parse::<u64>() {
-                if let Some(name) = find_symbol(symbols, addr) {
-                    tx.write_all(name).await?;
-                    tx.write_all(b"\n").await?;
-                } else {
-                    tx.write_all(b"unknown\n").await?;
-                }
-            } else {
-                tx.write_all(b"unknown\n").await?;
-            }
-        } else {
-            tx.write_all(b"unknown\n").await?;
+/// Waits for the chainloader's ready signal, three consecutive `0x03` bytes.
+async fn wait_for_ready(reader: &mut ReadHalf<'_>) -> io::Result<()> {
+    // scan whole bursts rather than single bytes, carrying the last two bytes of each
+    // burst over in case the signal is split across reads
+    let mut ready = [0u8; 2 + 64];
+    let mut carry = 0;
+    loop {
+        let n = reader.read(&mut ready[carry..]).await?;
+        if n == 0 {
+            return Err(io::ErrorKind::UnexpectedEof.into());
         }
-        Ok(true)
-    } else {
-        Ok(false)
+        let filled = carry + n;
+        if ready[..filled].windows(3).any(|w| w == b"\x03\x03\x03") {
+            return Ok(());
+        }
+        carry = filled.min(2);
+        ready.copy_within(filled - carry..filled, 0);
     }
 }
 
-fn find_symbol<'a>(symbols: &ElfFile<'a>, addr: u64) -> Option<&'a [u8]> {
-    if let Some(symtab) = symbols.find_section_by_name(".symtab") {
-        let Ok(SectionData::SymbolTable64(syms)) = symtab.get_data(symbols) else {
-            return None;
-        };
-        for entry in syms {
-            if (entry.value()..entry.value() + entry.size()).contains(&addr) {
-                let Ok(name) = entry.get_name(symbols) else {
-                    return None;
+/// Returns the reply to a `[sym?]` line from the kernel, or `None` if `line` is ordinary
+/// console output.
+fn answer_symbol_request<'a>(symbols: Option<&SymbolTable<'a>>, line: &[u8]) -> Option<&'a [u8]> {
+    let addr = line.strip_prefix(b"[sym?]")?;
+    let name = symbols.and_then(|symbols| {
+        let addr = String::from_utf8_lossy(addr).trim().parse::<u64>().ok()?;
+        symbols.find(addr)
+    });
+    Some(name.unwrap_or(b"unknown"))
+}
+
+/// Maps a file read-only, so its pages are faulted in as the transfer reaches them
+/// instead of the whole file being read into memory up front.
+fn map_file(path: &Path) -> io::Result<Mmap> {
+    let file = File::open(path)?;
+    // the loader only reads the mapping, and build outputs are not rewritten while it runs
+    unsafe { Mmap::map(&file) }
+}
+
+/// Symbols with a nonzero size, sorted by start address so lookups can binary search
+/// instead of walking the whole symbol table.
+struct SymbolTable<'a> {
+    /// `(start, end, name)` for each symbol
+    entries: Vec<(u64, u64, &'a [u8])>,
+    /// furthest end address among `entries[..=i]`
+    max_end: Vec<u64>,
+}
+
+impl<'a> SymbolTable<'a> {
+    fn new(elf: &ElfFile<'a>) -> Self {
+        let mut entries = Vec::new();
+        if let Some(symtab) = elf.find_section_by_name(".symtab")
+            && let Ok(SectionData::SymbolTable64(syms)) = symtab.get_data(elf)
+        {
+            for entry in syms {
+                if entry.size() == 0 {
+                    continue;
+                }
+                let Ok(name) = entry.get_name(elf) else {
+                    continue;
                 };
-                return Some(name.as_bytes());
+                entries.push((entry.value(), entry.value() + entry.size(), name.as_bytes()));
             }
         }
-        None
-    } else {
-        None
+        entries.sort_unstable_by_key(|&(start, _, _)| start);
+        let max_end = entries
+            .iter()
+            .scan(0, |max_end, &(_, end, _)| {
+                *max_end = end.max(*max_end);
+                Some(*max_end)
+            })
+            .collect();
+        Self { entries, max_end }
+    }
+
+    fn find(&self, addr: u64) -> Option<&'a [u8]> {
+        let idx = self.entries.partition_point(|&(start, _, _)| start <= addr);
+        // symbols can nest, so the closest start below `addr` isn't necessarily a match;
+        // walk back until no earlier symbol reaches past `addr`, returning the innermost
+        // symbol that contains it
+        (0..idx)
+            .rev()
+            .take_while(|&i| self.max_end[i] > addr)
+            .map(|i| self.entries[i])
+            .find(|&(_, end, _)| addr < end)
+            .map(|(_, _, name)| name)
     }
 }
@@ -26,8 +26,8 @@ pub struct ServerConfig {
     /// Address to bind the monitor server to
     #[clap(long, default_value_t = SocketAddr::V4(SocketAddrV4::new(Ipv4Addr::LOCALHOST, 1235)))]
     monitor_addr: SocketAddr,
-    /// Size of serial read/write chunks
-    #[clap(long, default_value_t = 16*1024)]
+    /// Size of the buffers used to read from the serial port and from monitor clients
+    #[clap(long, default_value_t = 64*1024)]
     chunk_size: usize,
 }
 
@@ -62,6 +62,9 @@ pub struct Server {
 impl Server {
     pub async fn bind(config: &ServerConfig) -> io::Result<Arc<Self>> {
         let serial_port = SerialStream::open(&tokio_serial::new(&config.device, config.baud))?;
+        if let Err(e) = set_low_latency(&serial_port) {
+            log::warn!("Couldn't enable low latency mode on {}: {e}", config.device);
+        }
         let monitor_socket = TcpListener::bind(config.monitor_addr).await?;
         log::info!("Listening on {}", config.monitor_addr);
 
@@ -201,3 +204,54 @@ impl Server {
         }
     }
 }
+
+/// Sets `ASYNC_LOW_LATENCY` on the serial port so the driver hands received bytes over
+/// right away. On FTDI adapters this also drops the latency timer from 16 ms to 1 ms.
+#[cfg(target_os = "linux")]
+fn set_low_latency(serial: &SerialStream) -> io::Result<()> {
+    use libc::{c_char, c_int, c_uchar, c_uint, c_ulong, c_ushort};
+    use std::os::fd::AsRawFd;
+
+    const ASYNC_LOW_LATENCY: c_int = 1 << 13;
+
+    /// `struct serial_struct` from `<linux/serial.h>`
+    #[repr(C)]
+    struct SerialStruct {
+        type_: c_int,
+        line: c_int,
+        port: c_uint,
+        irq: c_int,
+        flags: c_int,
+        xmit_fifo_size: c_int,
+        custom_divisor: c_int,
+        baud_base: c_int,
+        close_delay: c_ushort,
+        io_type: c_char,
+        reserved_char: c_char,
+        hub6: c_int,
+        closing_wait: c_ushort,
+        closing_wait2: c_ushort,
+        iomem_base: *mut c_uchar,
+        iomem_reg_shift: c_ushort,
+        port_high: c_uint,
+        iomap_base: c_ulong,
+    }
+
+    let fd = serial.as_raw_fd();
+    unsafe {
+        let mut info: SerialStruct = std::mem::zeroed();
+        if libc::ioctl(fd, libc::TIOCGSERIAL, &mut info) < 0 {
+            return Err(io::Error::last_os_error());
+        }
+        info.flags |= ASYNC_LOW_LATENCY;
+        if libc::ioctl(fd, libc::TIOCSSERIAL, &info) < 0 {
+            return Err(io::Error::last_os_error());
+        }
+    }
+    Ok(())
+}
+
+#[cfg(not(target_os = "linux"))]
+fn set_low_latency(_serial: &SerialStream) -> io::Result<()> {
+    Ok(())
+}